@@ -1,26 +1,113 @@
 
 import streamlit as st
 import pandas as pd
-import json
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import orjson
 import re
+import sqlite3
+import threading
+import time
+import httpx
 from dotenv import load_dotenv
 import os
+from typing import Literal
 
+from pydantic import BaseModel, ConfigDict, ValidationError
+from openai import (
+    AzureOpenAI, APIError, APIConnectionError, ContentFilterFinishReasonError, InternalServerError,
+    LengthFinishReasonError, OpenAIError, RateLimitError,
+)
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import HumanMessage
+from langchain_openai.chat_models.base import OpenAIRefusalError
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 
 # ---------------------------
 # Environment Setup
 # ---------------------------
 load_dotenv()
 
-llm = AzureChatOpenAI(
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-    api_version=os.getenv("OPENAI_API_VERSION"),
-    deployment_name=os.getenv("AZURE_DEPLOYMENT_NAME"),
-    temperature=0
-)
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite")
+
+# Persist model responses across runs; identical prompts (same deployment and
+# parameters) are answered from the local SQLite file instead of Azure.
+# Cached as a resource so reruns don't rebuild the SQLAlchemy engine each time.
+@st.cache_resource(show_spinner=False)
+def init_llm_cache():
+    set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH))
+
+init_llm_cache()
+
+@st.cache_resource(show_spinner=False)
+def get_verdict_cache():
+    # Per-email verdicts live in their own table of the same file. Prompts pack several
+    # emails, so the response cache alone misses as soon as a row is added or moved.
+    # The connection is shared by every session's script thread, hence the lock.
+    conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS email_verdicts (key TEXT PRIMARY KEY, analysis BLOB NOT NULL, prompt TEXT NOT NULL)"
+    )
+    return conn, threading.Lock()
+
+# Keep TLS connections to the Azure endpoint alive between calls instead of
+# paying a fresh handshake per request
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60)
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    # One long-lived loop for all async LLM calls; pooled async connections are
+    # bound to the loop that opened them, so a fresh asyncio.run per rerun would drop them
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+async def _warm_up(http_async_client):
+    try:
+        await http_async_client.head(os.getenv("AZURE_ENDPOINT"))
+    except httpx.HTTPError:
+        # Warm-up is best effort; the first real request will connect instead
+        pass
+
+@st.cache_resource(show_spinner=False)
+def get_clients():
+    http_client = httpx.Client(limits=HTTP_LIMITS, timeout=60)
+    http_async_client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=60)
+
+    llm = AzureChatOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+        api_version=os.getenv("OPENAI_API_VERSION"),
+        deployment_name=os.getenv("AZURE_DEPLOYMENT_NAME"),
+        temperature=0,
+        # Stream tokens back so progress is visible before each response completes
+        streaming=True,
+        # Retries are handled by tenacity in _ainvoke_with_retry
+        max_retries=0,
+        http_client=http_client,
+        http_async_client=http_async_client
+    )
+
+    # Plain OpenAI client for the Batch API (files + batches endpoints)
+    batch_client = AzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+        api_version=os.getenv("OPENAI_API_VERSION"),
+        http_client=http_client,
+    )
+
+    # Open the TLS connection in the background while the user is still choosing a file
+    if os.getenv("AZURE_ENDPOINT"):
+        asyncio.run_coroutine_threadsafe(_warm_up(http_async_client), get_event_loop())
+
+    return llm, batch_client
+
+llm, batch_client = get_clients()
 
 # ---------------------------
 # Risk Matrix
@@ -34,23 +121,100 @@ RISK_WEIGHTS = {
     "Employee Ethics": 3
 }
 
+# Maximum number of Azure OpenAI calls in flight at once
+MAX_CONCURRENCY = 10
+
+# Number of emails packed into a single Azure OpenAI request
+BATCH_SIZE = 5
+
+# Uploads with at least this many emails can opt in to an Azure OpenAI Batch API job
+BATCH_API_THRESHOLD = 50
+BATCH_POLL_SECONDS = 30
+
+# Live results table/chart are rebuilt every N emails or after this many seconds
+UI_REFRESH_EVERY = 10
+UI_REFRESH_SECONDS = 1.0
+
+# Transient Azure OpenAI failures are retried with exponential backoff (timeouts are connection errors)
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+MAX_API_ATTEMPTS = 3
+
+# Sent once, after the model's own reply, when that reply fails schema validation
+SCHEMA_RETRY_PROMPT = (
+    "Your previous response did not match the required schema: {error}\n"
+    "Return one entry per email with email_id, is_non_compliant, category (exactly one of the "
+    "listed categories), reason and evidence_line_ids."
+)
+
+# Sentences longer than this are truncated in the prompt
+MAX_SENTENCE_CHARS = 500
+
+# ---------------------------
+# Structured Output Schema
+# ---------------------------
+class EmailVerdict(BaseModel):
+    # extra="forbid" emits additionalProperties: false, which strict JSON schema mode requires
+    model_config = ConfigDict(extra="forbid")
+
+    email_id: str
+    is_non_compliant: bool
+    category: Literal[
+        "Secrecy",
+        "Market Manipulation/Misconduct",
+        "Market Bribery",
+        "Change in Communication",
+        "Complaints",
+        "Employee Ethics",
+    ]
+    reason: str
+    evidence_line_ids: list[int]
+
+class BatchVerdict(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    results: list[EmailVerdict]
+
+# The model is constrained to the schema, so responses need no fence-stripping or JSON repair.
+# include_raw keeps the AIMessage so a reply that fails validation can be shown back to the model.
+structured_llm = llm.with_structured_output(BatchVerdict, include_raw=True)
+
+# Same schema for Batch API requests, which bypass LangChain
+BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "BatchVerdict", "schema": BatchVerdict.model_json_schema(), "strict": True},
+}
+
 # ---------------------------
 # Helper Functions
 # ---------------------------
+# Use real lookbehind (not HTML-escaped)
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
 def split_sentences(text: str):
-    # Use real lookbehind (not HTML-escaped)
-    sentences = re.split(r'(?<=[.!?])\s+', text or "")
+    sentences = _SENT_RE.split(text or "")
     return [{"line_id": i + 1, "text": s} for i, s in enumerate(sentences) if s.strip()]
 
-def build_prompt(subject, body, sentences):
-    sentence_block = "\n".join([f"{s['line_id']}. {s['text']}" for s in sentences])
+def build_batch_prompt(emails):
+    email_blocks = []
+    for n, email in enumerate(emails, start=1):
+        # The numbered sentences carry the whole body, so the raw content isn't repeated
+        sentence_block = "\n".join([f"{s['line_id']}. {s['text'][:MAX_SENTENCE_CHARS]}" for s in email["sentences"]])
+        email_blocks.append(f"""
+=== Email E{n} ===
+Email Subject:
+{email["subject"]}
+
+Sentences:
+{sentence_block}
+""".strip())
+    email_block = "\n\n".join(email_blocks)
 
     return f"""
 You are a compliance surveillance assistant for a bank.
 
-Analyze the email below and return ONLY valid JSON.
+Analyze each of the {len(emails)} emails below independently and return ONLY valid JSON.
 
-Tasks:
+Tasks (for every email):
 1. Decide if the email is non-compliant (true/false)
 2. Assign ONE category from:
    - Secrecy
@@ -60,56 +224,337 @@ Tasks:
    - Complaints
    - Employee Ethics
 3. Explain the reason
-4. Identify the sentence line_ids that caused concern
-
-Email Subject:
-{subject}
+4. Identify the sentence line_ids (numbered per email) that caused concern
 
-Email Content:
-{body}
+{email_block}
 
-Sentences:
-{sentence_block}
-
-Return JSON in this format:
+Return JSON in this format, with one entry per email:
 {{
-  "is_non_compliant": true/false,
-  "category": "...",
-  "reason": "...",
-  "evidence_line_ids": [1,2]
+  "results": [
+    {{
+      "email_id": "E1",
+      "is_non_compliant": true/false,
+      "category": "...",
+      "reason": "...",
+      "evidence_line_ids": [1,2]
+    }}
+  ]
 }}
 """.strip()
 
-def analyze_email(subject, body):
-    sentences = split_sentences(body)
-    prompt = build_prompt(subject or "", body or "", sentences)
-
-    # You can also use llm.invoke(prompt) without HumanMessage
-    response = llm.invoke([HumanMessage(content=prompt)])
-
-    try:
-        raw = response.content.strip()
-        # Remove code fences if present
-        raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw)
-        raw = raw.strip()
-        # In case of accidental prefix before JSON
-        json_start = raw.find("{")
-        if json_start > 0:
-            raw = raw[json_start:]
-        result = json.loads(raw)
-    except json.JSONDecodeError:
-        result = {
+def map_verdicts(verdict, count, fallback_reason="Model response could not be parsed"):
+    """Map a BatchVerdict back to `count` per-email analysis dicts, in prompt order."""
+    by_email_id = {v.email_id: v.model_dump(exclude={"email_id"}) for v in verdict.results} if verdict else {}
+    return [
+        by_email_id.get(f"E{n}", {
             "is_non_compliant": False,
             "category": "Unknown",
-            "reason": "Model response could not be parsed",
+            "reason": fallback_reason,
             "evidence_line_ids": []
-        }
+        })
+        for n in range(1, count + 1)
+    ]
+
+def parse_batch_response(content, count):
+    try:
+        verdict = BatchVerdict.model_validate_json(content)
+    except ValidationError:
+        verdict = None
+    return map_verdicts(verdict, count)
+
+class TokenProgressHandler(AsyncCallbackHandler):
+    """Forwards each streamed token to `on_token` (used for live status updates)."""
+
+    def __init__(self, on_token):
+        self.on_token = on_token
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.on_token(token)
+
+class ReplyRecorder(AsyncCallbackHandler):
+    """Keeps the text of the latest streamed reply, so a reply rejected mid-stream can be shown back to the model."""
+
+    def __init__(self):
+        self.tokens = []
+
+    async def on_chat_model_start(self, serialized, messages, **kwargs):
+        # Each attempt (including tenacity retries) starts a fresh reply
+        self.tokens = []
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+    @property
+    def text(self):
+        return "".join(self.tokens)
+
+async def _ainvoke_with_retry(messages, callbacks, on_retry=None):
+    async for attempt in AsyncRetrying(
+        wait=wait_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(MAX_API_ATTEMPTS),
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        before_sleep=(lambda _: on_retry()) if on_retry else None,
+        reraise=True,
+    ):
+        with attempt:
+            return await structured_llm.ainvoke(messages, config={"callbacks": callbacks})
+
+async def _ainvoke_and_validate(messages, callbacks, reply, on_retry=None):
+    """Return (BatchVerdict or None, the model's reply message, validation error or None)."""
+    try:
+        result = await _ainvoke_with_retry(messages, callbacks, on_retry)
+    except ValidationError as e:
+        # With streaming=True the SDK validates the reply itself and raises before
+        # include_raw sees it; the recorder still has the text that was rejected
+        return None, AIMessage(content=reply.text), e
+    return result["parsed"], result["raw"], result["parsing_error"]
+
+async def analyze_batch_async(prompt, count, on_token=None, on_retry=None):
+    # ainvoke (rather than astream) keeps the SQLite response cache in play;
+    # with streaming=True the tokens still arrive incrementally via the callback
+    reply = ReplyRecorder()
+    callbacks = [reply] + ([TokenProgressHandler(on_token)] if on_token else [])
+    messages = [HumanMessage(content=prompt)]
+
+    try:
+        verdict, raw, error = await _ainvoke_and_validate(messages, callbacks, reply, on_retry)
+        # include_raw turns a refusal into a parsing_error; re-prompting would just pay for another one
+        if isinstance(error, OpenAIRefusalError):
+            return map_verdicts(None, count, "Model refused to analyze this batch")
+        if error is not None:
+            # Show the model its reply and what was wrong with it; the longer conversation
+            # also gets a new cache key, so the cached bad reply isn't returned again
+            if on_retry:
+                on_retry()
+            messages += [
+                raw,
+                HumanMessage(content=SCHEMA_RETRY_PROMPT.format(error=str(error)[:1000])),
+            ]
+            verdict, _, error = await _ainvoke_and_validate(messages, callbacks, reply, on_retry)
+            if isinstance(error, OpenAIRefusalError):
+                return map_verdicts(None, count, "Model refused to analyze this batch")
+    except RETRYABLE_ERRORS:
+        return map_verdicts(None, count, "Azure OpenAI request failed after retries")
+    # Non-retryable failures only affect this batch; the rest of the upload carries on
+    except LengthFinishReasonError:
+        return map_verdicts(None, count, "Model response was cut off at the token limit")
+    # Output filtering (finish_reason="content_filter") is not an APIError; prompt filtering is a 400
+    except ContentFilterFinishReasonError:
+        return map_verdicts(None, count, "Blocked by the Azure OpenAI content filter")
+    except APIError as e:
+        if getattr(e, "code", None) == "content_filter":
+            return map_verdicts(None, count, "Blocked by the Azure OpenAI content filter")
+        return map_verdicts(None, count, f"Azure OpenAI request failed ({type(e).__name__})")
+    except OpenAIError as e:
+        return map_verdicts(None, count, f"Azure OpenAI request failed ({type(e).__name__})")
+
+    # verdict is None when the second reply also fails validation
+    return map_verdicts(verdict, count)
+
+async def _analyze_with_limit(members, prompt, sem, on_token=None, on_retry=None):
+    async with sem:
+        analyses = await analyze_batch_async(prompt, len(members), on_token, on_retry)
+    return members, analyses, prompt
+
+def verdict_cache_key(subject, body):
+    """Key an email's verdict on its whitespace-normalized subject and body plus the deployment."""
+    text = " ".join(f"{subject}\0{body}".split())
+    return hashlib.sha256(f"{text}\0{os.getenv('AZURE_DEPLOYMENT_NAME')}".encode()).hexdigest()
+
+def lookup_verdicts(keys):
+    """Return {key: (analysis, prompt)} for the keys that already have a cached verdict."""
+    conn, lock = get_verdict_cache()
+    found = {}
+    with lock:
+        for key in keys:
+            row = conn.execute("SELECT analysis, prompt FROM email_verdicts WHERE key = ?", (key,)).fetchone()
+            if row:
+                found[key] = (orjson.loads(row[0]), row[1])
+    return found
+
+def store_verdict(key, analysis, prompt):
+    # Fallback analyses (category "Unknown") are not kept, so those emails are retried next run
+    if analysis.get("category", "Unknown") == "Unknown":
+        return
+    conn, lock = get_verdict_cache()
+    with lock, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO email_verdicts (key, analysis, prompt) VALUES (?, ?, ?)",
+            (key, orjson.dumps(analysis), prompt),
+        )
 
-    return result, sentences
+def plan_batches(emails):
+    """Group the emails without a cached verdict into requests of BATCH_SIZE.
+
+    Returns (batches, cached): batches is [(prompt, members)] where each member lists its row
+    indices; cached is [(idx, analysis, prompt)] for every row answered from the verdict cache.
+    """
+    # Duplicate emails in the same upload are only sent once
+    groups = {}
+    for i, e in enumerate(emails):
+        groups.setdefault(e["cache_key"], []).append(i)
+    hits = lookup_verdicts(groups)
+    cached = [(idx, *hits[key]) for key, idxs in groups.items() if key in hits for idx in idxs]
+    unique = [idxs for key, idxs in groups.items() if key not in hits]
+
+    batches = []
+    for start in range(0, len(unique), BATCH_SIZE):
+        members = unique[start:start + BATCH_SIZE]
+        batches.append((build_batch_prompt([emails[idxs[0]] for idxs in members]), members))
+    return batches, cached
+
+async def _run_all(batches, on_token=None, on_retry=None):
+    """Analyze batches MAX_CONCURRENCY requests at a time, yielding (idx, analysis, prompt) as batches complete."""
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(_analyze_with_limit(members, prompt, sem, on_token, on_retry))
+        for prompt, members in batches
+    ]
+
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            members, analyses, prompt = await next_done
+            for idxs, analysis in zip(members, analyses):
+                for idx in idxs:
+                    yield idx, analysis, prompt
+    finally:
+        # Streamlit interrupts the script on reruns; don't keep spending quota on unread batches
+        for task in tasks:
+            task.cancel()
+
+async def _anext_or_done(agen):
+    try:
+        return False, await agen.__anext__()
+    except StopAsyncIteration:
+        return True, None
+
+def iter_on_loop(agen, on_wait=None, poll_seconds=0.5):
+    """Drive an async generator on the shared event loop, yielding its items in the calling (script) thread."""
+    loop = get_event_loop()
+    future = None
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(_anext_or_done(agen), loop)
+            while True:
+                try:
+                    finished, item = future.result(timeout=poll_seconds)
+                    break
+                except concurrent.futures.TimeoutError:
+                    if on_wait:
+                        on_wait()
+            if finished:
+                return
+            yield item
+    finally:
+        # The loop outlives this script run, so stop the generator explicitly when the
+        # consumer goes away (rerun, exception). Cancelling an in-flight step unwinds the
+        # generator itself; otherwise it is suspended at a yield and can be closed.
+        if future is not None and not future.done():
+            future.cancel()
+        else:
+            asyncio.run_coroutine_threadsafe(agen.aclose(), loop)
+
+def submit_batch_job(batches):
+    lines = []
+    for n, (prompt, _) in enumerate(batches):
+        lines.append(orjson.dumps({
+            "custom_id": str(n),
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": os.getenv("AZURE_DEPLOYMENT_NAME"),
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0,
+                "response_format": BATCH_RESPONSE_FORMAT,
+            },
+        }))
+
+    input_file = batch_client.files.create(
+        file=("emails.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    job = batch_client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/chat/completions",
+        completion_window="24h",
+    )
+    return job.id
+
+def wait_for_batch_job(job_id, on_poll=None):
+    job = batch_client.batches.retrieve(job_id)
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        if on_poll:
+            on_poll(job)
+        time.sleep(BATCH_POLL_SECONDS)
+        job = batch_client.batches.retrieve(job_id)
+    return job
+
+def _batch_record_failure(record):
+    """Return why a Batch API output/error record has no usable reply, or None if it has one."""
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    if record.get("error") or response.get("status_code") != 200:
+        if (body.get("error") or {}).get("code") == "content_filter":
+            return "Blocked by the Azure OpenAI content filter"
+        return f"Azure OpenAI batch request failed ({response.get('status_code') or 'no response'})"
+    choice = (body.get("choices") or [{}])[0]
+    if choice.get("finish_reason") == "content_filter":
+        return "Blocked by the Azure OpenAI content filter"
+    if choice.get("finish_reason") == "length":
+        return "Model response was cut off at the token limit"
+    if (choice.get("message") or {}).get("refusal"):
+        return "Model refused to analyze this batch"
+    return None
+
+def read_batch_job_results(job, batches):
+    """Yield (idx, analysis, prompt) for every email from a finished batch job's output and error files."""
+    contents = {}
+    failures = {}
+    # Requests that failed inside a completed job come back in the error file (or with a non-200 status)
+    for file_id in (job.output_file_id, job.error_file_id):
+        if not file_id:
+            continue
+        for line in batch_client.files.content(file_id).content.splitlines():
+            if not line.strip():
+                continue
+            record = orjson.loads(line)
+            failure = _batch_record_failure(record)
+            if failure:
+                failures[record["custom_id"]] = failure
+                continue
+            try:
+                contents[record["custom_id"]] = record["response"]["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                # Unexpected record shape; the batch keeps its parse fallback below
+                pass
+
+    for n, (prompt, members) in enumerate(batches):
+        if str(n) in failures:
+            analyses = map_verdicts(None, len(members), failures[str(n)])
+        elif str(n) in contents:
+            analyses = parse_batch_response(contents[str(n)], len(members))
+        else:
+            analyses = map_verdicts(None, len(members), "No result returned by the batch job")
+        for idxs, analysis in zip(members, analyses):
+            for idx in idxs:
+                yield idx, analysis, prompt
+
+@st.cache_data(show_spinner=False)
+def load_emails(file_bytes: bytes) -> pd.DataFrame:
+    # Memoized on the file contents so widget reruns don't re-parse the workbook
+    # Use explicit engine for xlsx
+    return pd.read_excel(io.BytesIO(file_bytes), engine="openpyxl")
 
 def calculate_priority(category):
     return RISK_WEIGHTS.get(category, 1)
 
+def calculate_priorities(result_df):
+    # Vectorized calculate_priority over the whole table; compliant rows score 0
+    return (
+        result_df["Category"].map(RISK_WEIGHTS).fillna(1).astype(int)
+        .where(result_df["Non-Compliant"].astype(bool), 0)
+    )
+
 # ---------------------------
 # Streamlit UI (Two-Column Layout)
 # ---------------------------
@@ -119,11 +564,28 @@ st.title("📧 AI-Driven Communication Surveillance (POC)")
 uploaded_file = st.file_uploader("Upload Raw Email Excel File", type=["xlsx"])
 
 if uploaded_file:
-    # Use explicit engine for xlsx
-    df = pd.read_excel(uploaded_file, engine="openpyxl")
+    df = load_emails(uploaded_file.getvalue())
 
     st.success(f"{len(df)} emails loaded")
 
+    # Large uploads may opt in to the Batch API (~50% cost, no rate limits, up to 24h turnaround)
+    job_key = f"batch_job_{uploaded_file.file_id}"
+    # Finished results for this upload; widget reruns (e.g. the inspector) reuse them instead of re-analyzing
+    results_key = f"results_{uploaded_file.file_id}"
+    saved_results = st.session_state.get(results_key)
+    use_batch_api = job_key in st.session_state
+    if saved_results is None and not use_batch_api and len(df) >= BATCH_API_THRESHOLD:
+        # Nothing is sent until the user picks a mode and confirms, so no live quota is spent on a batch-sized file
+        mode = st.radio("Analysis mode", ["Live", "Azure OpenAI Batch API job"], horizontal=True)
+        use_batch_api = mode != "Live"
+        if use_batch_api:
+            st.info(
+                "The emails will be analyzed as an Azure OpenAI Batch API job, which can take up to "
+                "24 hours and requires a deployment that supports batch processing."
+            )
+        if not st.button("Submit as batch job" if use_batch_api else "Start analysis"):
+            st.stop()
+
     # Create two columns: left for guided workflow, right for outputs
     left_col, right_col = st.columns([0.95, 1.05])
 
@@ -139,76 +601,44 @@ if uploaded_file:
         table_placeholder = st.empty()
         chart_placeholder = st.empty()
 
-    results = []
+    # Raw per-email results in completion order; priority is derived for the whole table at once
+    records = []
+    record_rows = []
+    details = {}
+    last_refresh = {"at": 0.0}
     total = len(df)
 
-    # Main processing loop
-    for idx, row in df.iterrows():
-        # --- LEFT: Update status to "Preparing prompt"
-        with left_col:
-            status.update(
-                label=f"Email {idx+1}/{total}: preparing prompt",
-                state="running",
-            )
-
-        subject = row.get("Subject", "") or ""
-        body = row.get("Message Body", "") or ""
-        sentences = split_sentences(body)
-        prompt = build_prompt(subject, body, sentences)
-
-        # --- LEFT: Update status to "Invoking Azure OpenAI"
-        with left_col:
-            status.update(
-                label=f"Email {idx+1}/{total}: invoking Azure OpenAI",
-                state="running",
-            )
-
-        # Invoke the model (you can also use llm.invoke(prompt))
-        response = llm.invoke([HumanMessage(content=prompt)])
-
-        # Parse model response to JSON
-        raw = response.content.strip()
-        raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw)  # strip code fences
-        raw = raw.strip()
-        json_start = raw.find("{")
-        if json_start > 0:
-            raw = raw[json_start:]
-
-        try:
-            analysis = json.loads(raw)
-            with left_col:
-                status.update(
-                    label=f"Email {idx+1}/{total}: parsing JSON response",
-                    state="running",
-                )
-        except json.JSONDecodeError:
-            analysis = {
-                "is_non_compliant": False,
-                "category": "Unknown",
-                "reason": "Model response could not be parsed",
-                "evidence_line_ids": []
-            }
-            with left_col:
-                status.update(
-                    label=f"Email {idx+1}/{total}: JSON parse fallback",
-                    state="running",
-                )
-
-        # Compute priority & evidence mapping
+    # --- LEFT: Split every email upfront so the batches can run concurrently
+    with left_col:
+        status.update(label=f"Preparing {total} emails", state="running")
+
+    # Null-fill and coerce every column at once (absent columns become empty strings),
+    # then split all bodies in one pass
+    columns = {"Email Address From": "from", "Email Address To": "to", "Subject": "subject", "Message Body": "body"}
+    email_df = df.reindex(columns=list(columns)).rename(columns=columns).fillna("").astype(str)
+    email_df["sentences"] = email_df["body"].map(split_sentences)
+    email_df["sentence_by_id"] = email_df["sentences"].map(lambda ss: {s["line_id"]: s["text"] for s in ss})
+    email_df["cache_key"] = [verdict_cache_key(subject, body) for subject, body in zip(email_df["subject"], email_df["body"])]
+    emails = email_df.to_dict("records")
+
+    def render_details(idx):
+        subject = emails[idx]["subject"]
+        sentences = emails[idx]["sentences"]
+        prompt = details[idx]["prompt"]
+        analysis = details[idx]["analysis"]
         priority = (
             calculate_priority(analysis.get("category", ""))
             if analysis.get("is_non_compliant")
             else 0
         )
-        evidence_ids = set(analysis.get("evidence_line_ids", []))
-        evidence_texts = [s["text"] for s in sentences if s["line_id"] in evidence_ids]
+        evidence_texts = details[idx]["evidence_texts"]
 
         # --- LEFT: Rich, collapsible explainers for users
-        with left_col.expander(f"📜 What we did: {subject or '(no subject)'}", expanded=False):
+        with left_col.expander(f"📜 What we did: {subject or '(no subject)'}", expanded=True):
             st.markdown("""
 **Workflow (high level)**
 1. Numbered the sentences in the email body
-2. Queried Azure OpenAI with a JSON-only prompt
+2. Queried Azure OpenAI with a JSON-only prompt (batched with other emails)
 3. Parsed JSON and mapped evidence line IDs to the text
 4. Computed priority using the risk matrix
 """)
@@ -232,10 +662,7 @@ if uploaded_file:
 
             # 3) Model Response (Raw JSON) – cleaned and shown for education/debugging
             with st.expander("📦 Model response (raw JSON)", expanded=False):
-                try:
-                    st.code(json.dumps(analysis, indent=2), language="json")
-                except Exception:
-                    st.write(analysis)
+                st.json(analysis)
 
             # 4) Risk Scoring Explanation – how priority was computed
             with st.expander("🧮 Risk scoring explanation", expanded=False):
@@ -272,40 +699,177 @@ if uploaded_file:
                 else:
                     st.info("No evidence line IDs were provided by the model.")
 
+    def show_results_table():
+        result_df = pd.DataFrame(records, index=record_rows)
+
+        with right_col:
+            if not result_df.empty:
+                result_df.insert(
+                    result_df.columns.get_loc("Category") + 1,
+                    "Priority Score",
+                    calculate_priorities(result_df),
+                )
+                sorted_df = result_df.sort_index().sort_values("Priority Score", ascending=False, kind="stable")
+                table_placeholder.dataframe(sorted_df, use_container_width=True)
+                # Summary chart
+                chart_placeholder.bar_chart(result_df["Category"].value_counts())
+            else:
+                table_placeholder.info("No results yet.")
+                chart_placeholder.info("No results to summarize yet.")
+
+    def record_result(idx, analysis, prompt, done):
+        email = emails[idx]
+        subject = email["subject"]
+
+        with left_col:
+            status.update(
+                label=f"Email {idx+1}/{total}: parsed JSON response",
+                state="running",
+            )
+
+        # Compute evidence mapping in the model's order, dropping repeated or unknown ids
+        by_id = email["sentence_by_id"]
+        evidence_texts = [by_id[i] for i in dict.fromkeys(analysis.get("evidence_line_ids", [])) if i in by_id]
+
+        # Keep what the explainers need; the widgets are only built for the inspected email
+        details[idx] = {
+            "prompt": prompt,
+            "analysis": analysis,
+            "evidence_texts": evidence_texts,
+        }
+
         # ✅ Append current result to list BEFORE building the DataFrame
-        results.append({
-            "From": row.get("Email Address From", "") or "",
-            "To": row.get("Email Address To", "") or "",
+        records.append({
+            "From": email["from"],
+            "To": email["to"],
             "Subject": subject,
             "Non-Compliant": analysis.get("is_non_compliant", False),
             "Category": analysis.get("category", "Unknown"),
-            "Priority Score": priority,
             "Reason": analysis.get("reason", ""),
             "Evidence Lines": evidence_texts
         })
+        record_rows.append(idx)
 
-        # --- RIGHT: Live update table & chart
-        result_df = pd.DataFrame(results)
-
-        with right_col:
-            # Only sort if the column exists and DataFrame not empty
-            if not result_df.empty and "Priority Score" in result_df.columns:
-                sorted_df = result_df.sort_values("Priority Score", ascending=False)
-                table_placeholder.dataframe(sorted_df, use_container_width=True)
-            else:
-                table_placeholder.info("No results yet.")
-
-            # Summary chart
-            if not result_df.empty and "Category" in result_df.columns:
-                chart_placeholder.bar_chart(result_df["Category"].value_counts())
-            else:
-                chart_placeholder.info("No results to summarize yet.")
+        # --- RIGHT: Live update table & chart (throttled; always refreshed on the last email)
+        now = time.monotonic()
+        if done % UI_REFRESH_EVERY == 0 or now - last_refresh["at"] > UI_REFRESH_SECONDS or done == total:
+            last_refresh["at"] = now
+            show_results_table()
 
         # Update progress bar
         with left_col:
-            pct = int(((idx + 1) / total) * 100)
+            pct = int((done / total) * 100)
             progress_bar.progress(pct)
 
+    if saved_results is not None:
+        records = saved_results["records"]
+        record_rows = saved_results["record_rows"]
+        details = saved_results["details"]
+        show_results_table()
+        with left_col:
+            progress_bar.progress(100)
+    else:
+        saved_job = st.session_state.get(job_key)
+        if saved_job is not None:
+            # Reuse the plan the job was submitted with; its custom_ids index these batches
+            batches, cached = saved_job["batches"], saved_job["cached"]
+        else:
+            batches, cached = plan_batches(emails)
+
+        # Emails with a cached verdict are shown straight away; only the rest go to Azure
+        done = 0
+        for idx, analysis, prompt in cached:
+            done += 1
+            record_result(idx, analysis, prompt, done)
+
+        if use_batch_api and batches:
+            if saved_job is None:
+                with left_col:
+                    status.update(label=f"Submitting {len(batches)} requests to the Azure OpenAI Batch API", state="running")
+                try:
+                    job_id = submit_batch_job(batches)
+                except APIError as e:
+                    with left_col:
+                        status.update(label=f"Batch job submission failed: {e}", state="error")
+                    st.stop()
+                st.session_state[job_key] = {"id": job_id, "batches": batches, "cached": cached}
+            else:
+                job_id = saved_job["id"]
+
+            def show_job_status(job):
+                counts = job.request_counts
+                with left_col:
+                    status.update(
+                        label=f"Batch job {job_id}: {job.status}"
+                              + (f" ({counts.completed}/{counts.total} requests)" if counts else ""),
+                        state="running",
+                    )
+
+            try:
+                job = wait_for_batch_job(job_id, on_poll=show_job_status)
+            except APIError as e:
+                with left_col:
+                    status.update(label=f"Could not check batch job {job_id}: {e}", state="error")
+                st.stop()
+            if job.status != "completed":
+                with left_col:
+                    status.update(label=f"Batch job {job_id} ended with status: {job.status}", state="error")
+                del st.session_state[job_key]
+                st.stop()
+
+            for idx, analysis, prompt in read_batch_job_results(job, batches):
+                done += 1
+                store_verdict(emails[idx]["cache_key"], analysis, prompt)
+                record_result(idx, analysis, prompt, done)
+        elif batches:
+            # --- LEFT: Update status to "Invoking Azure OpenAI"
+            with left_col:
+                status.update(
+                    label=f"Invoking Azure OpenAI for {total - len(cached)} emails "
+                          f"({BATCH_SIZE} per request, {MAX_CONCURRENCY} requests at a time)",
+                    state="running",
+                )
+
+            # Tokens and retries are counted on the event-loop thread; Streamlit is only updated from this one
+            streamed = {"tokens": 0, "retries": 0}
+
+            def count_token(token):
+                streamed["tokens"] += 1
+
+            def count_retry():
+                streamed["retries"] += 1
+
+            # --- LEFT: Show streaming progress while waiting for the next batch to finish
+            def show_stream_progress():
+                with left_col:
+                    status.update(
+                        label=f"Streaming responses: {done}/{total} emails analyzed, "
+                              f"{streamed['tokens']} tokens received"
+                              + (f", {streamed['retries']} retries" if streamed["retries"] else ""),
+                        state="running",
+                    )
+
+            # Main processing loop: results arrive in completion order, not row order
+            for idx, analysis, prompt in iter_on_loop(
+                _run_all(batches, on_token=count_token, on_retry=count_retry),
+                on_wait=show_stream_progress,
+            ):
+                done += 1
+                store_verdict(emails[idx]["cache_key"], analysis, prompt)
+                record_result(idx, analysis, prompt, done)
+
+        st.session_state[results_key] = {"records": records, "record_rows": record_rows, "details": details}
+
     # Finalize status
     with left_col:
         status.update(label="Analysis complete", state="complete")
+
+    # --- LEFT: Explainers for a single email, chosen after processing
+    with left_col:
+        inspect_idx = st.selectbox(
+            "🔍 Inspect email",
+            options=sorted(details),
+            format_func=lambda i: f"{i+1}. {emails[i]['subject'] or '(no subject)'}",
+        )
+    if inspect_idx is not None:
+        render_details(inspect_idx)